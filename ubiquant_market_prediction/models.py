@@ -139,12 +139,20 @@ class MLPModel(BaseModel):
 
         x_train = self._format_embedding(x_train)
 
+        # a compiled regressor needs a fixed batch size to replay cuda graphs
+        drop_last = self.mlp_params.get("compile_regressor", False)
+        if drop_last and len(x_train) < self.batch_size:
+            raise ValueError(
+                f"compile_regressor requires at least batch_size={self.batch_size} "
+                f"training samples, got {len(x_train)}"
+            )
+
         # Define the loader using x_train, y_train
         loader = DataLoader(
             dataset=TensorLoader(x_train, y_train),
             batch_size=self.batch_size,
             shuffle=True,
-            drop_last=False,
+            drop_last=drop_last,
         )
 
         self.training_loss_value = []
@@ -188,11 +196,30 @@ class MLPModel(BaseModel):
         self.engine.eval()
         x = self._format_embedding(x)
         x = to_tensor(x)
-        pred = to_numpy(self.engine(x))
+        if self.mlp_params.get("compile_regressor", False):
+            pred = self._predict_fixed_batches(x)
+        else:
+            pred = to_numpy(self.engine(x))
         self.engine.train()
 
         return pred
 
+    def _predict_fixed_batches(self, x):
+        # the compiled regressor has static shapes: predict in batch_size
+        # chunks, padding the last one, to avoid recompiling for each size
+        preds = []
+        with torch.no_grad():
+            for start in range(0, len(x), self.batch_size):
+                x_batch = x[start : start + self.batch_size]
+                n_rows = len(x_batch)
+                if n_rows < self.batch_size:
+                    padding = x_batch.new_zeros(
+                        (self.batch_size - n_rows, *x_batch.shape[1:])
+                    )
+                    x_batch = torch.cat([x_batch, padding])
+                preds.append(to_numpy(self.engine(x_batch))[:n_rows])
+        return np.concatenate(preds)
+
 
 class RNNModel(BaseModel):
     def __init__(
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 import torch.nn as nn
 import torch
 import numpy as np
@@ -19,7 +20,7 @@ class NNArch(nn.Module):
         assert isinstance(num_embeddings_list, list)
         assert len(embedding_dim_list) == len(num_embeddings_list)
 
-        self.embedding_layers = []
+        self.embedding_layers = nn.ModuleList()
         for embedding_dim, num_embeddings in zip(
             embedding_dim_list, num_embeddings_list
         ):
@@ -28,6 +29,7 @@ class NNArch(nn.Module):
                 embedding_dim=embedding_dim,
             )
             self.embedding_layers.append(embedding_layer)
+        self.num_emb = len(embedding_dim_list)
         # update input size based on embedding sizes
         input_size = input_size + sum(embedding_dim_list) - len(embedding_dim_list)
         return input_size
@@ -40,16 +42,36 @@ class NNArch(nn.Module):
     ):
         self.use_attention = use_attention
         if self.use_attention:
-            self.attention_layer = []
-            prev_size = input_size
-            for size in attention_hidden_sizes:
-                self.attention_layer.append(nn.Linear(prev_size, size))
-                self.attention_layer.append(get_activation(activation_type))
-                prev_size = size
+            self.attention = GLUAttention(
+                input_size, attention_hidden_sizes, activation_type
+            )
 
-            self.attention_layer.append(nn.Linear(prev_size, input_size))
-            self.attention_layer.append(nn.Sigmoid())
-            self.attention_layer = nn.Sequential(*self.attention_layer)
+
+class GLUAttention(nn.Module):
+    """
+    Gates the input with a sigmoid MLP of itself: x * sigmoid(MLP(x)).
+    """
+
+    def __init__(
+        self,
+        input_size,
+        attention_hidden_sizes=[8],
+        activation_type="leakyrelu",
+    ):
+        super(GLUAttention, self).__init__()
+        layers = []
+        prev_size = input_size
+        for size in attention_hidden_sizes:
+            layers.append(nn.Linear(prev_size, size))
+            layers.append(get_activation(activation_type))
+            prev_size = size
+
+        layers.append(nn.Linear(prev_size, input_size))
+        layers.append(nn.Sigmoid())
+        self.net = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return x * self.net(x)
 
 
 class MLPArch(NNArch):
@@ -64,8 +86,12 @@ class MLPArch(NNArch):
         use_embedding=False,
         embedding_dim_list=None,
         num_embeddings_list=None,
+        use_autocast=False,
+        compile_regressor=False,
     ):
         super(MLPArch, self).__init__()
+        # parameters stay in fp32, only the forward runs in bf16
+        self.use_autocast = use_autocast
 
         input_size = self._set_embedding(
             input_size,
@@ -90,20 +116,37 @@ class MLPArch(NNArch):
             past_size = size
         layers.append(nn.Linear(past_size, 1))
         self.regressor = nn.Sequential(*layers)
+        if compile_regressor:
+            if not hasattr(torch, "compile"):
+                raise ValueError("compile_regressor requires torch>=2.0")
+            # shapes are static: batches must have a fixed size (see MLPModel.fit)
+            self.regressor = torch.compile(
+                self.regressor, mode="reduce-overhead", fullgraph=True, dynamic=False
+            )
 
     def forward(self, x):
+        with tf32_matmul(self.use_autocast), torch.autocast(
+            device_type=x.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.use_autocast,
+        ):
+            out = self._forward(x)
+        return out.float()
+
+    def _forward(self, x):
 
         if self.use_embedding:
-            embedded_features = []
-            for i, embedding_layer in enumerate(self.embedding_layers):
-                cat_feat = x[:, i].int()
-                emb_feat = embedding_layer(cat_feat)
-                embedded_features.append(emb_feat)
-            embedded_features = torch.cat(embedded_features, 1)
-            x = torch.cat([embedded_features, x[:, len(self.embedding_layers) :]], 1)
+            # cast all categorical columns at once, then lookup each table
+            # and concat embeddings with the other features in a single cat
+            cat_feats = x[:, : self.num_emb].long()
+            embedded_features = [
+                embedding_layer(cat_feats[:, i])
+                for i, embedding_layer in enumerate(self.embedding_layers)
+            ]
+            x = torch.cat(embedded_features + [x[:, self.num_emb :]], 1)
 
         if self.use_attention:
-            x = x * self.attention_layer(x)
+            x = self.attention(x)
 
         return self.regressor(x).squeeze(-1)
 
@@ -127,8 +170,12 @@ class RNNArch(nn.Module):
         use_embedding=False,
         embedding_dim_list=None,
         num_embeddings_list=None,
+        use_autocast=False,
+        compile_non_rnn=False,
     ):
         super(RNNArch, self).__init__()
+        # parameters stay in fp32, only the forward runs in bf16
+        self.use_autocast = use_autocast
 
         self.use_embedding = use_embedding
         if self.use_embedding:
@@ -136,7 +183,7 @@ class RNNArch(nn.Module):
             assert isinstance(num_embeddings_list, list)
             assert len(embedding_dim_list) == len(num_embeddings_list)
 
-            self.embedding_layers = []
+            self.embedding_layers = nn.ModuleList()
             for embedding_dim, num_embeddings in zip(
                 embedding_dim_list, num_embeddings_list
             ):
@@ -145,21 +192,15 @@ class RNNArch(nn.Module):
                     embedding_dim=embedding_dim,
                 )
                 self.embedding_layers.append(embedding_layer)
+            self.num_emb = len(embedding_dim_list)
             # update input size based on embedding sizes
             input_size = input_size + sum(embedding_dim_list) - len(embedding_dim_list)
 
         self.use_attention = use_attention
         if self.use_attention:
-            self.attention_layer = []
-            prev_size = input_size
-            for size in attention_hidden_sizes:
-                self.attention_layer.append(nn.Linear(prev_size, size))
-                self.attention_layer.append(get_activation(activation_type))
-                prev_size = size
-
-            self.attention_layer.append(nn.Linear(prev_size, input_size))
-            self.attention_layer.append(nn.Sigmoid())
-            self.attention_layer = nn.Sequential(*self.attention_layer)
+            self.attention = GLUAttention(
+                input_size, attention_hidden_sizes, activation_type
+            )
 
         # Initialize RNN
         self.rnn = getattr(nn, rnn_type)(
@@ -179,27 +220,75 @@ class RNNArch(nn.Module):
         layers.append(nn.Linear(hidden_size, 1))
         self.regressor = nn.Sequential(*layers)
 
+        if compile_non_rnn:
+            if not hasattr(torch, "compile"):
+                raise ValueError("compile_non_rnn requires torch>=2.0")
+            # the rnn call can't be captured: compile the modules around it
+            if self.use_attention:
+                self.attention = torch.compile(
+                    self.attention, mode="reduce-overhead", fullgraph=True
+                )
+            self.regressor = torch.compile(
+                self.regressor, mode="reduce-overhead", fullgraph=True
+            )
+
     def forward(self, x, h_state=None):
+        with tf32_matmul(self.use_autocast), torch.autocast(
+            device_type=x.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.use_autocast,
+        ):
+            out, h_state = self._forward(x, h_state)
+        # LSTM returns (h, c), GRU/RNN a single tensor
+        if isinstance(h_state, tuple):
+            h_state = tuple(h.float() for h in h_state)
+        else:
+            h_state = h_state.float()
+        return out.float(), h_state
+
+    def _forward(self, x, h_state=None):
+        x = self._pre_rnn(x)
+        out_rnn, h_state = self.rnn(x, h_state)
+        return self._post_rnn(out_rnn), h_state
+
+    def _pre_rnn(self, x):
 
         if self.use_embedding:
-            embedded_features = []
-            for i, embedding_layer in enumerate(self.embedding_layers):
-                cat_feat = x[:, :, i].int()
-                emb_feat = embedding_layer(cat_feat)
-                embedded_features.append(emb_feat)
-            embedded_features = torch.cat(embedded_features, 2)
-            x = torch.cat([embedded_features, x[:, :, len(self.embedding_layers) :]], 2)
+            # cast all categorical columns at once, then lookup each table
+            # and concat embeddings with the other features in a single cat
+            cat_feats = x[:, :, : self.num_emb].long()
+            embedded_features = [
+                embedding_layer(cat_feats[:, :, i])
+                for i, embedding_layer in enumerate(self.embedding_layers)
+            ]
+            x = torch.cat(embedded_features + [x[:, :, self.num_emb :]], 2)
 
         if self.use_attention:
-            x = x * self.attention_layer(x)
+            x = self.attention(x)
 
-        # RNN
-        out_rnn, h_state = self.rnn(x, h_state)
+        return x
+
+    def _post_rnn(self, out_rnn):
+        # nn.Linear broadcasts over leading dims: N,T,F_hidden --> N,T,F_out
+        out_reg = self.regressor(out_rnn)
+        return out_reg.squeeze(-1)
 
-        # The following line is doing: N,T,F_hidden --> NT, F_hidden --> N,T,F_out
-        N, T, _ = x.shape
-        out_reg = self.regressor(out_rnn.reshape([N * T, -1])).reshape([N, T, -1])
-        return out_reg.squeeze(-1), h_state
+
+@contextmanager
+def tf32_matmul(enabled=True):
+    """
+    Allow TF32 for the fp32 matmuls left outside autocast regions (torch>=1.12).
+    The precision is process-wide, so the previous one is restored on exit.
+    """
+    if not enabled or not hasattr(torch, "set_float32_matmul_precision"):
+        yield
+        return
+    previous_precision = torch.get_float32_matmul_precision()
+    torch.set_float32_matmul_precision("high")
+    try:
+        yield
+    finally:
+        torch.set_float32_matmul_precision(previous_precision)
 
 
 def get_activation(activation_type):
@@ -217,34 +306,34 @@ def to_numpy(x):
 
 
 def to_tensor(x):
-    if type(x) != type(torch.tensor(0)):
+    if not isinstance(x, torch.Tensor):
         x = torch.tensor(x.astype("float32"))
     return x
 
 
 class TensorLoader:
     def __init__(self, x, y):
-        self.x = x.astype("float32")
-        self.y = y.astype("float32")
+        # convert once, items are then returned as views
+        self.x = self._to_float_tensor(x)
+        self.y = self._to_float_tensor(y)
 
     def __len__(self):
         return len(self.x)
 
     def __getitem__(self, index):
-        x = to_tensor(self.x[index])
-        y = to_tensor(self.y[index])
-        return x, y
+        return self.x[index], self.y[index]
+
+    @staticmethod
+    def _to_float_tensor(x):
+        return torch.from_numpy(x.astype(np.float32, copy=False))
 
 
 class TimeSplitter:
     def __init__(self, x, y, window_size):
-        N, T, F = x.shape
-        self.x_chunked = []
-        self.y_chunked = []
-        for start_t in range(0, T, window_size):  # this could be rolling!!!!
-            end_t = start_t + window_size
-            self.x_chunked.append(x[:, start_t:end_t])
-            self.y_chunked.append(y[:, start_t:end_t])
+        # chunks are views along T, the last one may be shorter than window_size
+        # (this could be rolling!!!!)
+        self.x_chunked = torch.split(x, window_size, dim=1)
+        self.y_chunked = torch.split(y, window_size, dim=1)
         self.order = np.arange(len(self.x_chunked))
 
     def __len__(self):
@@ -254,14 +343,15 @@ class TimeSplitter:
         return self.x_chunked[index], self.y_chunked[index]
 
 
-def corr_loss(targ, pred):
-    targ_mean = targ.mean(axis=0)
-    pred_mean = pred.mean(axis=0)
-    num = ((targ - targ_mean) * (pred - pred_mean)).sum(axis=0)
-    den = (
-        ((targ - targ_mean) ** 2).sum(axis=0) * ((pred - pred_mean) ** 2).sum(axis=0)
-    ) ** 0.5
-    avg_corr = (num / den).mean()
+def corr_loss(targ, pred, eps=1e-8):
+    # reductions are done in fp32 to avoid cancellation with bf16 predictions
+    targ = targ.float()
+    pred = pred.float()
+    targ_var, targ_mean = torch.var_mean(targ, dim=0, unbiased=False)
+    pred_var, pred_mean = torch.var_mean(pred, dim=0, unbiased=False)
+    cov = (targ * pred).mean(dim=0) - targ_mean * pred_mean
+    # eps avoids nans when targets or predictions are constant
+    avg_corr = (cov / torch.sqrt(targ_var * pred_var + eps)).mean()
     return 1 - avg_corr
 
 
@@ -12,6 +12,11 @@ def get_preprocessor(preprocessor_type, preprocessor_args):
     return preprocessors[preprocessor_type.lower()](**preprocessor_args)
 
 
+def fill_nan_inplace(x):
+    # one nan mask and one masked store; infs are kept as they are
+    np.copyto(x, 0, where=np.isnan(x))
+
+
 class BasePreprocessor:
     @abstractclassmethod
     def run(self, train_data, valid_data):
@@ -71,10 +76,8 @@ class NaivePreprocessor(BasePreprocessor):
         x_train = self._run(train_data, fit_scaler=True)
         y_train = train_data.target.values
 
-        if self.crop_high is not None:
-            y_train[y_train > self.crop_high] = self.crop_high
-        if self.crop_low is not None:
-            y_train[y_train < self.crop_low] = self.crop_low
+        if self.crop_low is not None or self.crop_high is not None:
+            np.clip(y_train, self.crop_low, self.crop_high, out=y_train)
 
         return x_train, y_train
 
@@ -100,15 +103,11 @@ class NaivePreprocessor(BasePreprocessor):
         if len(self.time_id_features) == 0:
             return df
 
+        # transform broadcasts the aggregates back to the rows, no merge needed
         dgb = df.groupby("time_id")[self.time_id_features]
-        dgb_mean = dgb.mean()
-        dgb_std = dgb.std()
-        dgb_mean.columns = [f"time_mean_{c}" for c in self.time_id_features]
-        dgb_std.columns = [f"time_std_{c}" for c in self.time_id_features]
-        dgb_mean.reset_index(inplace=True)
-        dgb_std.reset_index(inplace=True)
-        df = pd.merge(df, dgb_mean, how="left", on="time_id")
-        df = pd.merge(df, dgb_std, how="left", on="time_id")
+        dgb_mean = dgb.transform("mean").add_prefix("time_mean_")
+        dgb_std = dgb.transform("std").add_prefix("time_std_")
+        df = pd.concat([df, dgb_mean, dgb_std], axis=1)
         return df
 
 
@@ -124,6 +123,7 @@ class TensorPreprocessor(BasePreprocessor):
         crop_low=None,
         crop_high=None,
         time_id_features_idx=[],
+        random_state=123,
     ):
         self.fill_na_target = fill_na_target
         self.crop_low = crop_low
@@ -136,6 +136,7 @@ class TensorPreprocessor(BasePreprocessor):
             scaler_fit_sample,
             scaler_features_args,
             scaler_targets_args,
+            random_state,
         )
 
     def run(self, train_data, valid_data):
@@ -147,16 +148,14 @@ class TensorPreprocessor(BasePreprocessor):
         x_train, y_train = self.ts_scaler.transform(x_train, y_train)
         x_valid, y_valid = self.ts_scaler.transform(x_valid, y_valid)
 
-        # set timesteps,repeat over N axis
-        timesteps_train = np.arange(y_train.shape[1])
-        timesteps_valid = np.arange(y_valid.shape[1])
-        timesteps_train = timesteps_train.reshape(1, -1).repeat(len(y_train), 0)
-        timesteps_valid = timesteps_valid.reshape(1, -1).repeat(len(y_valid), 0)
+        # set timesteps, broadcast over N axis (read-only views)
+        timesteps_train = np.broadcast_to(np.arange(y_train.shape[1]), y_train.shape)
+        timesteps_valid = np.broadcast_to(np.arange(y_valid.shape[1]), y_valid.shape)
 
         return x_train, x_valid, timesteps_train, timesteps_valid, y_train, y_valid
 
     def run_inference(self, x):
-        x[np.isnan(x)] = 0
+        fill_nan_inplace(x)
         return self.ts_scaler.transform(x)
 
     def run_train(self, data):
@@ -174,16 +173,14 @@ class TensorPreprocessor(BasePreprocessor):
             x = x.copy()
             y = y.copy()
 
-        x = self._add_time_features(x)
+        fill_nan_inplace(x)
 
-        x[np.isnan(x)] = 0
+        x = self._add_time_features(x)
         if self.fill_na_target:
-            y[np.isnan(y)] = 0
+            fill_nan_inplace(y)
 
-        if self.crop_high is not None:
-            y[y > self.crop_high] = self.crop_high
-        if self.crop_low is not None:
-            y[y < self.crop_low] = self.crop_low
+        if self.crop_low is not None or self.crop_high is not None:
+            np.clip(y, self.crop_low, self.crop_high, out=y)
         return x, y
 
     def _add_time_features(self, x):
@@ -191,14 +188,13 @@ class TensorPreprocessor(BasePreprocessor):
         if len(self.time_id_features_idx) == 0:
             return x
 
-        # compute mean/std per timestep
-        time_x_mean = np.nanmean(x[:, :, self.time_id_features_idx], axis=0)
-        time_x_std = np.nanstd(x[:, :, self.time_id_features_idx], axis=0)
-        # reshape
-        time_x_mean = np.expand_dims(time_x_mean, axis=0)
-        time_x_std = np.expand_dims(time_x_std, axis=0)
-        time_x_mean = np.repeat(time_x_mean, x.shape[0], axis=0)
-        time_x_std = np.repeat(time_x_std, x.shape[0], axis=0)
+        # compute mean/std per timestep (nans are already filled)
+        time_x = x[:, :, self.time_id_features_idx]
+        time_x_mean = time_x.mean(axis=0, keepdims=True)
+        time_x_std = time_x.std(axis=0, keepdims=True)
+        # broadcast over N axis without copies
+        time_x_mean = np.broadcast_to(time_x_mean, time_x.shape)
+        time_x_std = np.broadcast_to(time_x_std, time_x.shape)
         # concat
         x = np.concatenate([x, time_x_mean, time_x_std], axis=2)
         return x
@@ -212,19 +208,19 @@ class TimeSeriesTensorScaler:
         scaler_fit_sample=None,
         scaler_features_args={},
         scaler_targets_args={},
+        random_state=123,
     ):
 
         self.scaler_features = self._get_scaler(scaler_features, scaler_features_args)
         self.scaler_targets = self._get_scaler(scaler_targets, scaler_targets_args)
         self.scaler_fit_sample = scaler_fit_sample
+        self._rng = np.random.default_rng(random_state)
 
     def fit(self, features, targets):
         if self.scaler_features is not None:
             feat_reshaped = features.reshape(-1, features.shape[2])
             if self.scaler_fit_sample is not None:
-                sel_idx = np.random.choice(
-                    len(feat_reshaped), size=self.scaler_fit_sample, replace=False
-                )
+                sel_idx = self._sample_idx(len(feat_reshaped))
                 feat_reshaped = feat_reshaped[sel_idx]
 
             self.scaler_features.fit(feat_reshaped)
@@ -232,35 +228,41 @@ class TimeSeriesTensorScaler:
         if self.scaler_targets is not None:
             targ_reshaped = targets.reshape(-1, 1)
             if self.scaler_fit_sample is not None:
-                sel_idx = np.random.choice(
-                    len(targ_reshaped), size=self.scaler_fit_sample, replace=False
-                )
+                sel_idx = self._sample_idx(len(targ_reshaped))
                 targ_reshaped = targ_reshaped[sel_idx]
 
             self.scaler_targets.fit(targ_reshaped)
 
     def transform(self, features, targets=None):
 
-        scaled_features = features.copy()
+        # scalers work on 2d arrays: flatten the N,T axes and transform at once
+        # (transform already allocates the output, no need for extra copies)
+        scaled_features = features
         if self.scaler_features is not None:
-            for i in range(len(features)):
-                scaled_features[i] = self.scaler_features.transform(features[i])
+            scaled_features = self.scaler_features.transform(
+                features.reshape(-1, features.shape[-1])
+            ).reshape(features.shape)
 
         if targets is None:
             return scaled_features
 
-        scaled_targets = targets.copy()
+        scaled_targets = targets
         if self.scaler_targets is not None:
-            for i in range(len(targets)):
-                scaled_targets[i : i + 1] = self.scaler_targets.transform(
-                    targets[i : i + 1].transpose(1, 0)
-                ).transpose(1, 0)
+            scaled_targets = self.scaler_targets.transform(
+                targets.reshape(-1, 1)
+            ).reshape(targets.shape)
 
         return scaled_features, scaled_targets
 
+    def _sample_idx(self, n):
+        # sampling with replacement is O(sample size) and fine to fit a scaler
+        return self._rng.integers(0, n, size=self.scaler_fit_sample)
+
     def _get_scaler(self, scaler, scaler_args):
         if scaler is None:
             return None
+        if scaler == "StandardScaler":
+            return StandardScalerFast(**scaler_args)
         return getattr(sklearn.preprocessing, scaler)(**scaler_args)
 
     def inverse_transform(self, targets):
@@ -273,3 +275,43 @@ class TimeSeriesTensorScaler:
         return self.scaler_targets.inverse_transform(targets.reshape(-1, 1)).reshape(
             targets.shape
         )
+
+
+class StandardScalerFast:
+    """
+    Numpy version of sklearn StandardScaler, skipping sklearn input validation.
+    """
+
+    def __init__(self, copy=True, with_mean=True, with_std=True):
+        # as in sklearn, copy=False transforms in place (unless out is given)
+        self.copy = copy
+        self.with_mean = with_mean
+        self.with_std = with_std
+
+    def fit(self, x):
+        n_features = x.shape[1]
+        self.mean_ = np.zeros(n_features, dtype=np.float32)
+        self.scale_ = np.ones(n_features, dtype=np.float32)
+        # same as sklearn: nans are ignored in fit and kept in transform,
+        # statistics are accumulated in float64
+        if self.with_mean:
+            self.mean_ = np.nanmean(x, axis=0, dtype=np.float64).astype(np.float32)
+        if self.with_std:
+            self.scale_ = np.nanstd(x, axis=0, dtype=np.float64).astype(np.float32)
+            # same as sklearn: constant features are not scaled
+            self.scale_[self.scale_ == 0] = 1
+        return self
+
+    def transform(self, x, out=None):
+        if out is None:
+            out = np.empty_like(x) if self.copy else x
+        np.subtract(x, self.mean_, out=out)
+        np.divide(out, self.scale_, out=out)
+        return out
+
+    def inverse_transform(self, x, out=None):
+        if out is None:
+            out = np.empty_like(x) if self.copy else x
+        np.multiply(x, self.scale_, out=out)
+        np.add(out, self.mean_, out=out)
+        return out